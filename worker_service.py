@@ -1,7 +1,10 @@
-import requests
+import asyncio
+import httpx
 import os
 import json
-import time
+import random
+import signal
+import orjson
 import logging
 
 # ตั้งค่า Logging
@@ -12,149 +15,325 @@ logger = logging.getLogger(__name__)
 CAMUNDA_REST_URL = os.environ.get("CAMUNDA_REST_URL", "http://operaton:8080/engine-rest")
 FASTAPI_URL = os.environ.get("FASTAPI_URL", "http://fastapi-api:8000/api/v1")
 
-# กำหนด Topic เดียวสำหรับ External HTTP Calls ทั้งหมด
+# Topic สำหรับ External HTTP Calls ทั้งหมด
 GENERIC_HTTP_TOPIC = "http-request-topic"
-TOPICS = [GENERIC_HTTP_TOPIC]
+# เลือกเฉพาะบาง Topic ได้ด้วย WORKER_TOPICS (คั่นด้วย comma) ถ้าไม่กำหนดจะรับทุก Topic ที่มี Handler
+WORKER_TOPICS = os.environ.get("WORKER_TOPICS", "")
 
 WORKER_ID = "generic-http-worker"
+DEFAULT_RETRIES = 3 # จำนวน Retry เริ่มต้น เมื่อ Task ยังไม่เคยถูกกำหนด retries
+RETRY_TIMEOUT_MS = 60000 # รอ 60 วินาทีก่อน Engine ปล่อยให้ Fetch Task ที่ล้มเหลวอีกครั้ง
+# จำนวน Worker Loop ที่ Poll พร้อมกันใน Process เดียว (ใช้ AsyncClient ร่วมกัน)
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "4"))
 MAX_TASKS = 5
 LOCK_DURATION_MS = 30000 # 30 วินาที
-POLL_INTERVAL_SEC = 5 # 5 วินาที
+ASYNC_RESPONSE_TIMEOUT_MS = 29000 # Long polling: ให้ Engine ถือ Request ไว้จนกว่าจะมีงาน (สูงสุด 29 วินาที)
+# Exponential backoff + jitter เมื่อเชื่อมต่อ Engine ไม่สำเร็จ
+BACKOFF_BASE_SEC = 0.5
+BACKOFF_MAX_SEC = 30
+BACKOFF_JITTER_SEC = 0.3
+# เวลาตอน Shutdown: รอ Task ที่กำลังประมวลผล + รอ Unlock ต้องรวมกันน้อยกว่า stop_grace_period ของ Docker (30 วินาที)
+SHUTDOWN_TIMEOUT_SEC = 20
+UNLOCK_TIMEOUT_SEC = 5
+
+# Timeout ต่อ Request (connect 3.05 วินาที) เพื่อไม่ให้ Engine หรือ API ที่ค้างทำให้ Worker ค้างตาม
+REQ_TIMEOUT = httpx.Timeout(10.0, connect=3.05)
+FETCH_TIMEOUT = httpx.Timeout(35.0, connect=3.05) # read ต้องนานกว่า ASYNC_RESPONSE_TIMEOUT_MS ฝั่ง Engine
+CONNECT_RETRIES = 3 # Retry ระดับ Transport เฉพาะตอนเปิด Connection ไม่สำเร็จ (ปลอดภัยกับ POST เพราะ Request ยังไม่ถูกส่ง)
+
+# ใช้ AsyncClient เดียวทั้งโมดูล เพื่อใช้ Connection เดิมซ้ำ (HTTP keep-alive) และยิง Request พร้อมกันได้
+CLIENT = httpx.AsyncClient(
+    headers={"Content-Type": "application/json", "Connection": "keep-alive"},
+    transport=httpx.AsyncHTTPTransport(
+        retries=CONNECT_RETRIES,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    ),
+    timeout=REQ_TIMEOUT,
+)
+
+# URL และ Body ที่ไม่เปลี่ยนแปลง สร้างครั้งเดียวตอนโหลดโมดูล
+FETCH_URL = f"{CAMUNDA_REST_URL}/external-task/fetchAndLock"
+COMPLETE_URL_FMT = f"{CAMUNDA_REST_URL}/external-task/%s/complete"
+FAILURE_URL_FMT = f"{CAMUNDA_REST_URL}/external-task/%s/failure"
+UNLOCK_URL_FMT = f"{CAMUNDA_REST_URL}/external-task/%s/unlock"
+
+# Task ที่ Fetch และ Lock มาแล้วแต่ Handler ยังทำงานไม่เสร็จ (ใช้ Unlock ตอน Shutdown)
+LOCKED_TASK_IDS = set()
 
 # --- Helper Functions ---
 
 def get_variable_value(variables, name, default=""):
-    """ฟังก์ชันดึงค่าตัวแปรอย่างปลอดภัย"""
-    try:
-        # Camunda API ส่งตัวแปรมาในรูปแบบ {"variableName": {"value": "...", "type": "..."}}
-        return variables.get(name, {}).get("value", default)
-    except Exception as e:
-        logger.error(f"Error extracting variable '{name}': {e}")
-        return default
+    """ฟังก์ชันดึงค่าตัวแปรจาก dict ที่ flatten แล้ว (ดู flatten_variables) คืนค่า default ถ้าไม่มีตัวแปรนั้น"""
+    return variables.get(name, default)
 
-def complete_task(task_id):
+def flatten_variables(variables):
+    """
+    แปลงตัวแปรจาก Camunda API ในรูปแบบ {"variableName": {"value": "...", "type": "..."}}
+    ให้เป็น {"variableName": "..."} ครั้งเดียวต่อ Task ก่อนส่งให้ Handler
+    """
+    return {k: v["value"] for k, v in variables.items() if isinstance(v, dict) and "value" in v}
+
+async def complete_task(task_id, worker_id):
     """ส่งสัญญาณ Complete กลับไปยัง Operaton Engine"""
-    url = f"{CAMUNDA_REST_URL}/external-task/{task_id}/complete"
-    payload = {"workerId": WORKER_ID, "variables": {}}
     try:
-        requests.post(url, json=payload).raise_for_status()
-        logger.info(f"Task {task_id} completed successfully.")
+        response = await CLIENT.post(COMPLETE_URL_FMT % task_id, content=COMPLETE_BODIES[worker_id], timeout=REQ_TIMEOUT)
+        response.raise_for_status()
+        logger.info("Task %s completed successfully.", task_id)
         return True
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to complete task {task_id}. Error: {e}")
+    except httpx.HTTPError as e:
+        logger.error("Failed to complete task %s. Error: %s", task_id, e)
         return False
 
-def handle_failure(task_id, error_message):
-    """จัดการเมื่อ Worker ประมวลผลล้มเหลว"""
-    url = f"{CAMUNDA_REST_URL}/external-task/{task_id}/failure"
+async def handle_failure(task, error_message, worker_id):
+    """
+    จัดการเมื่อ Worker ประมวลผลล้มเหลว โดยลด retries ของ Task ลงทีละ 1
+    ให้ Engine ส่ง Task กลับมาใหม่จนกว่า retries จะหมด
+    """
+    task_id = task.get("id")
+    retries = (task.get("retries") or DEFAULT_RETRIES) - 1
     payload = {
-        "workerId": WORKER_ID,
+        "workerId": worker_id,
         "errorMessage": "Generic HTTP Worker failed to execute request.",
         "errorDetails": error_message,
-        "retries": 0, 
-        "retryTimeout": 60000 
+        "retries": max(retries, 0),
+        "retryTimeout": RETRY_TIMEOUT_MS
     }
     try:
-        requests.post(url, json=payload).raise_for_status()
-        logger.warning(f"Task {task_id} reported failure to Engine.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to report failure for task {task_id}. Error: {e}")
+        response = await CLIENT.post(FAILURE_URL_FMT % task_id, content=orjson.dumps(payload), timeout=REQ_TIMEOUT)
+        response.raise_for_status()
+        logger.warning("Task %s reported failure to Engine. Retries left: %s", task_id, max(retries, 0))
+    except httpx.HTTPError as e:
+        logger.error("Failed to report failure for task %s. Error: %s", task_id, e)
+
+async def unlock_task(task_id):
+    """ปลด Lock ของ Task ที่ยังประมวลผลไม่เสร็จ ให้ Worker อื่นรับไปทำต่อได้ทันที"""
+    try:
+        response = await CLIENT.post(UNLOCK_URL_FMT % task_id, timeout=REQ_TIMEOUT)
+        response.raise_for_status()
+        logger.info("Task %s unlocked.", task_id)
+    except httpx.HTTPError as e:
+        logger.error("Failed to unlock task %s. Error: %s", task_id, e)
 
 # --- Generic Task Handler ---
 
-def handle_generic_http_request(task_id, variables):
+async def handle_generic_http_request(variables):
     """
     จัดการ External Task โดยการสร้างและส่ง HTTP Request ไปยัง URL ที่กำหนด 
     โดยใช้ตัวแปร BPMN: requestUrl, httpMethod, requestPayload
+    คืนค่า None เมื่อสำเร็จ หรือข้อความ Error เมื่อล้มเหลว (process_tasks จะรายงาน Failure ให้)
     """
     
     # ดึงตัวแปรที่จำเป็นในการสร้าง Request
-    http_method = get_variable_value(variables, "httpMethod", "POST").upper()
+    http_method = str(get_variable_value(variables, "httpMethod") or "POST").upper()
     request_url = get_variable_value(variables, "requestUrl")
     payload_str = get_variable_value(variables, "requestPayload", "{}")
 
     if not request_url:
         error_msg = "BPMN variable 'requestUrl' is missing or empty."
         logger.error(error_msg)
-        handle_failure(task_id, error_msg)
-        return False
+        return error_msg
 
     try:
-        # 1. Parse Payload (Body)
-        payload = json.loads(payload_str)
+        # 1. Parse Payload (Body) เพื่อตรวจสอบว่าเป็น JSON ที่ถูกต้อง
+        try:
+            payload = orjson.loads(payload_str)
+        except orjson.JSONDecodeError:
+            # orjson ไม่รองรับตัวเลขเกิน 64-bit ที่ json มาตรฐานรองรับ
+            payload = json.loads(payload_str)
         
-        # 2. ส่ง HTTP Request
-        logger.info(f"Executing {http_method} to {request_url} with payload: {payload}")
+        # 2. ส่ง HTTP Request โดยใช้ Payload เดิมตามที่ได้รับมา (ไม่ encode ใหม่)
+        logger.info("Executing %s to %s with payload: %s", http_method, request_url, payload)
         
-        response = requests.request(
+        response = await CLIENT.request(
             method=http_method,
             url=request_url,
-            json=payload,
-            timeout=10 # กำหนด Timeout 10 วินาที
+            content=payload_str.encode(),
+            timeout=REQ_TIMEOUT
         )
         response.raise_for_status() # ตรวจสอบ HTTP Status (4xx, 5xx)
 
-        logger.info(f"Request to {request_url} successful. Status: {response.status_code}")
-        return True
+        logger.info("Request to %s successful. Status: %s", request_url, response.status_code)
+        return None
         
     except json.JSONDecodeError as e:
-        error_msg = f"Failed to parse 'requestPayload' JSON. Error: {e}"
-        handle_failure(task_id, error_msg)
-    except requests.exceptions.RequestException as e:
-        error_msg = f"HTTP Request Failed ({http_method} {request_url}). Error: {e}"
-        handle_failure(task_id, error_msg)
+        return f"Failed to parse 'requestPayload' JSON. Error: {e}"
+    except httpx.HTTPError as e:
+        return f"HTTP Request Failed ({http_method} {request_url}). Error: {e}"
     except Exception as e:
-        error_msg = f"An unexpected error occurred: {e}"
-        handle_failure(task_id, error_msg)
-        
-    return False
-
-def process_tasks(tasks):
-    """กระจายงานไปยัง Task Handler ที่เหมาะสม"""
-    for task in tasks:
-        task_id = task.get("id")
-        topic = task.get("topicName")
-        variables = task.get("variables", {})
-        
-        logger.info(f"Processing Task ID: {task_id} with Topic: {topic}")
+        return f"An unexpected error occurred: {e}"
 
-        success = False
-        if topic == GENERIC_HTTP_TOPIC:
-            # เรียก handler และเก็บผลลัพธ์ความสำเร็จ
-            success = handle_generic_http_request(task_id, variables)
-        else:
-            logger.warning(f"Unknown topic: {topic}. Skipping.")
-            
-        # ตรวจสอบผลลัพธ์: ถ้าสำเร็จ ให้เรียก complete_task
-        if success:
-            complete_task(task_id)
+# --- Topic Registry ---
 
-def fetch_and_lock():
-    """ดึงและล็อคงามจาก Operaton Engine"""
-    url = f"{CAMUNDA_REST_URL}/external-task/fetchAndLock"
-    payload = {
-        "workerId": WORKER_ID,
+# Topic -> Handler: Handler รับตัวแปรที่ flatten แล้ว และคืนค่า None เมื่อสำเร็จ หรือข้อความ Error เมื่อล้มเหลว
+HANDLERS = {
+    GENERIC_HTTP_TOPIC: handle_generic_http_request,
+}
+
+def select_topics(handlers, worker_topics):
+    """คืนรายชื่อ Topic ที่ Worker นี้จะ Subscribe ตามค่า WORKER_TOPICS"""
+    wanted = [t.strip() for t in worker_topics.split(",") if t.strip()]
+    if not wanted:
+        return list(handlers)
+    for topic in wanted:
+        if topic not in handlers:
+            logger.warning("No handler registered for topic %s. Ignoring.", topic)
+    return [t for t in wanted if t in handlers]
+
+TOPICS = select_topics(HANDLERS, WORKER_TOPICS)
+
+# แต่ละ Worker Loop ใช้ workerId ของตัวเอง เพื่อให้ Engine แยกเจ้าของ Lock ได้ถูกต้อง
+WORKER_IDS = [f"{WORKER_ID}-{i}" for i in range(WORKER_COUNT)]
+FETCH_BODIES = {
+    worker_id: orjson.dumps({
+        "workerId": worker_id,
         "maxTasks": MAX_TASKS,
-        "usePriority": True,
+        "usePriority": False, # ไม่มี Topic ใดกำหนด Priority จึงให้ Engine ใช้ Query แบบไม่เรียงลำดับ
+        "asyncResponseTimeout": ASYNC_RESPONSE_TIMEOUT_MS,
         "topics": [{"topicName": t, "lockDuration": LOCK_DURATION_MS} for t in TOPICS]
-    }
-    
+    })
+    for worker_id in WORKER_IDS
+}
+COMPLETE_BODIES = {
+    worker_id: orjson.dumps({"workerId": worker_id, "variables": {}})
+    for worker_id in WORKER_IDS
+}
+
+async def _process(task, worker_id):
+    """ประมวลผล Task เดียว แล้วรายงาน Complete/Failure กลับไปยัง Engine ทันทีที่ Handler ทำงานเสร็จ"""
+    task_id = task.get("id")
+    topic = task.get("topicName")
+    variables = flatten_variables(task.get("variables") or {})
+
+    logger.info("Processing Task ID: %s with Topic: %s", task_id, topic)
+
+    handler = HANDLERS.get(topic)
+    if handler is None:
+        logger.warning("Unknown topic: %s. Skipping.", topic)
+        LOCKED_TASK_IDS.discard(task_id)
+        return
+
+    # เรียก handler และเก็บผลลัพธ์ความสำเร็จ (Error ที่ Handler ไม่ได้จัดการถือเป็น Failure ของ Task นี้)
+    try:
+        error_message = await handler(variables)
+    except Exception as e:
+        logger.exception("Unhandled error in handler for task %s", task_id)
+        error_message = f"Unhandled handler error: {e}"
+    # Handler ทำงานเสร็จแล้ว (อาจมี Side effect ไปแล้ว) จึงห้าม Unlock ให้ Engine ส่งงานนี้ซ้ำ
+    LOCKED_TASK_IDS.discard(task_id)
+
+    if error_message is None:
+        await complete_task(task_id, worker_id)
+    else:
+        await handle_failure(task, error_message, worker_id)
+
+async def process_tasks(tasks, worker_id):
+    """
+    กระจายงานไปยัง Task Handler ที่เหมาะสม โดยประมวลผลทุก Task พร้อมกัน
+    Complete/Failure ของแต่ละ Task ถูกส่งพร้อมกันโดยไม่ต้องรอ Task อื่นใน Batch
+    """
+    # รอทุก Task จนจบแม้บาง Task จะ Error เพื่อไม่ให้เหลือ Task ที่ยังทำงานค้างอยู่โดยไม่มีใครดูแล
+    results = await asyncio.gather(*[_process(t, worker_id) for t in tasks], return_exceptions=True)
+    for task, result in zip(tasks, results):
+        if isinstance(result, Exception):
+            # ไม่รู้ว่า Handler ทำงานไปแล้วหรือยัง จึงไม่ Unlock ปล่อยให้ Lock หมดอายุเอง
+            logger.error("Unexpected error while processing task %s: %s", task.get("id"), result)
+            LOCKED_TASK_IDS.discard(task.get("id"))
+
+async def fetch_and_lock(worker_id, stop_event):
+    """ดึงและล็อคงามจาก Operaton Engine"""
+    # ยกเลิกเฉพาะ Long poll ที่รออยู่เมื่อได้รับ Signal ส่วน Task ที่ Fetch มาแล้วจะประมวลผลต่อจนเสร็จ
+    poll = asyncio.create_task(CLIENT.post(FETCH_URL, content=FETCH_BODIES[worker_id], timeout=FETCH_TIMEOUT))
+    stop_waiter = asyncio.create_task(stop_event.wait())
     try:
-        response = requests.post(url, json=payload)
+        await asyncio.wait([poll, stop_waiter], return_when=asyncio.FIRST_COMPLETED)
+        if not poll.done():
+            return True
+
+        response = poll.result()
         response.raise_for_status()
-        tasks = response.json()
+        tasks = orjson.loads(response.content)
         
         if tasks:
-            logger.info(f"Fetched {len(tasks)} tasks.")
-            process_tasks(tasks)
+            logger.info("[%s] Fetched %s tasks.", worker_id, len(tasks))
+            LOCKED_TASK_IDS.update(task.get("id") for task in tasks)
+            await process_tasks(tasks, worker_id)
         else:
-            logger.info("No tasks to fetch. Waiting...")
+            logger.debug("[%s] Long-poll returned no tasks.", worker_id)
+        return True
+
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        logger.error("Error fetching tasks from Camunda Engine: %s", e)
+        return False
+    finally:
+        poll.cancel()
+        stop_waiter.cancel()
+
+async def worker_loop(worker_id, stop_event):
+    """Poll -> ประมวลผล -> Complete วนไปเรื่อยๆ สำหรับ workerId เดียว จนกว่าจะได้รับ Signal"""
+    consecutive_errors = 0
+    while not stop_event.is_set():
+        # Long polling ทำให้ Poll รอบถัดไปได้ทันที ไม่ว่าจะได้งานหรือไม่
+        if await fetch_and_lock(worker_id, stop_event):
+            consecutive_errors = 0
+            continue
+
+        # เชื่อมต่อ Engine ไม่สำเร็จ: รอแบบ exponential backoff + jitter เพื่อไม่ให้ทุก Worker ยิงพร้อมกัน
+        backoff = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** consecutive_errors)
+        if backoff < BACKOFF_MAX_SEC:
+            # หยุดเพิ่มเมื่อถึงเพดานแล้ว ไม่ให้ 2 ** n ใหญ่จนแปลงเป็น float ไม่ได้ (OverflowError)
+            consecutive_errors += 1
+        delay = backoff + random.random() * BACKOFF_JITTER_SEC
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+async def main():
+    logger.info("Starting Generic HTTP Worker x%s. Target Engine: %s. Target API (Internal Base): %s. Topics: %s. Polling...", WORKER_COUNT, CAMUNDA_REST_URL, FASTAPI_URL, TOPICS)
+
+    # SIGTERM (docker stop) / SIGINT: หยุด Fetch งานใหม่ รอ Task ที่กำลังทำให้เสร็จและรายงานผล
+    # แล้วปลด Lock เฉพาะ Task ที่ Handler ยังทำไม่เสร็จภายใน SHUTDOWN_TIMEOUT_SEC
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    stop_waiter = asyncio.create_task(stop_event.wait())
+    workers = [asyncio.create_task(worker_loop(worker_id, stop_event)) for worker_id in WORKER_IDS]
+    try:
+        # รอจนกว่าจะได้รับ Signal หรือมี Worker Loop ใดหยุดด้วย Error
+        done, _ = await asyncio.wait([stop_waiter, *workers], return_when=asyncio.FIRST_COMPLETED)
+        if stop_waiter in done:
+            logger.info("Shutdown signal received. Finishing in-flight tasks...")
+        stop_event.set()
+
+        _, pending = await asyncio.wait(workers, timeout=SHUTDOWN_TIMEOUT_SEC)
+        if pending:
+            logger.warning("In-flight tasks did not finish within %s seconds. Cancelling.", SHUTDOWN_TIMEOUT_SEC)
+    finally:
+        stop_waiter.cancel()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        # ถึงตรงนี้ Worker Loop ทุกตัวจบแล้ว Task ที่ยังเหลือใน LOCKED_TASK_IDS จึงมีแค่ Task ที่ Handler ถูกยกเลิกก่อนทำเสร็จ
+        if LOCKED_TASK_IDS:
+            logger.info("Unlocking %s in-flight tasks.", len(LOCKED_TASK_IDS))
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*[unlock_task(task_id) for task_id in LOCKED_TASK_IDS]),
+                    timeout=UNLOCK_TIMEOUT_SEC,
+                )
+            except asyncio.TimeoutError:
+                logger.error("Unlocking did not finish within %s seconds.", UNLOCK_TIMEOUT_SEC)
+        await CLIENT.aclose()
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching tasks from Camunda Engine: {e}")
+    # ส่งต่อ Error ของ Worker Loop ที่หยุดเอง (ถ้ามี) ให้ Process จบด้วย Error
+    for worker in workers:
+        if not worker.cancelled() and worker.exception() is not None:
+            raise worker.exception()
 
 if __name__ == "__main__":
-    logger.info(f"Starting Generic HTTP Worker. Target Engine: {CAMUNDA_REST_URL}. Target API (Internal Base): {FASTAPI_URL}. Polling...")
-    while True:
-        fetch_and_lock()
-        time.sleep(POLL_INTERVAL_SEC)
+    # ใช้ uvloop (libuv) แทน Event Loop มาตรฐานของ asyncio
+    import uvloop
+    uvloop.run(main())